@@ -1,14 +1,45 @@
 import logging
+import logging.handlers
+import pathlib
+from functools import wraps, lru_cache
 
 formatter = logging.Formatter("[{asctime}] [{levelname}] - {name} : {message}", 
                               "%Y-%m-%d %H:%M:%S", style = "{")
 
+_LOG_DIR = pathlib.Path("./logs")
+_LOG_DIR.mkdir(exist_ok = True)
+
+@lru_cache(None)
+def get_logger(name: str) -> logging.Logger:
+    """Returns the logger for a module, logging to ./logs/{name}.log.
+
+    The log file is only opened on the first write and is rotated at 1 MiB.
+    
+    ### Parameters
+        name : str
+            The name of the logger (and log file).
+    """
+    handler = logging.handlers.RotatingFileHandler(
+        _LOG_DIR / f"{name}.log", maxBytes = 1 << 20, backupCount = 3, delay = True
+    )
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(formatter)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
 def exception_handler(logger):
     def decorator(function):
+        if not __debug__:
+            return function         # No wrapper when running with python -O
+        
+        @wraps(function)
         def wrapper(*args, **kwargs):
             try:
-                function(*args, **kwargs)
+                return function(*args, **kwargs)
             except Exception as e:
-                logger.error(e)
+                logger.error(e, exc_info=True)
         return wrapper
     return decorator
@@ -1,12 +1,27 @@
 """
 Adpated from code written by chentir
 """
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
 import pyvisa
-import nidaqmx
 
-rm = pyvisa.ResourceManager() 
-listing = rm.list_resources()
-system = nidaqmx.system.System.local()
+@cache
+def get_gpib_resources():
+    """Returns the VISA resource manager and the detected GPIB instruments. 
+    The resources are only listed once and shared by all callers.
+    
+    ### Returns
+        rm : pyvisa.ResourceManager
+            The VISA resource manager.
+        
+        tools : list[str]
+            The resource names of the GPIB instruments.
+    """
+    rm = pyvisa.ResourceManager() 
+    listing = rm.list_resources()
+    tools = [i for i in listing if 'GPIB' in i]
+    return rm, tools
 
 def get_address_IL():
     """Returns the index of the selected instrument in the 'tools' list.
@@ -15,15 +30,19 @@ def get_address_IL():
         selection : str
             The index of the chosen instrument in the 'tools' list.
     """
+    rm, tools = get_gpib_resources()
 
     print("##############################################")
     print("Present GPIB instruments")
 
-    tools=[i for i in listing if 'GPIB' in i]
+    def identify(tool):
+        with rm.open_resource(tool, read_termination = '\r\n') as buffer:     # Closed before the TSL reopens it
+            return buffer.query('*IDN?')
 
-    for i in range(len(tools)):
-        buffer = rm.open_resource(tools[i], read_termination = '\r\n')
-        print(i+1, ": ", buffer.query('*IDN?'))
+    # Queries the instruments in parallel so the GPIB round trips overlap
+    with ThreadPoolExecutor(max_workers = max(len(tools), 1)) as executor:
+        for i, idn in enumerate(executor.map(identify, tools)):
+            print(i+1, ": ", idn)
 
     print('')
     print("##############################################")
@@ -31,4 +50,4 @@ def get_address_IL():
     print("Select light source")
     selection = input()
     
-    return selection
\ No newline at end of file
+    return selection
@@ -1,36 +1,42 @@
-import logging
-import os
+import socket
 
-from ..error_handling.error_handling import exception_handler, formatter
+import numpy as np
 
-filename = os.path.basename(__file__)
-filename = os.path.splitext(filename)[0]
-if not os.path.exists("./logs"):
-    os.mkdir("./logs")
+from ..error_handling.error_handling import exception_handler, get_logger
 
-logger = logging.getLogger(filename)
-handler = logging.FileHandler(f"./logs/{filename}.log")
+logger = get_logger(__name__.rsplit(".", 1)[-1])
 
-handler.setLevel(logging.DEBUG)
-logger.setLevel(logging.DEBUG)
+__author__ = "Andrew Kruger"
 
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# numpy dtypes of the samples for each data unit ("BIN" transfers are big-endian)
+_BIN_DTYPE = {"RAW": np.dtype(">i2"), "VOLTS": np.dtype(">f4")}
+_ASCII_DTYPE = {"RAW": np.int16, "VOLTS": np.float32}
 
-__author__ = "Andrew Kruger"
+_AVG_CMD = {"ON": "ACQ:AVG ON", "OFF": "ACQ:AVG OFF"}
+_UNITS_CMD = {"RAW": "ACQ:DATA:UNITS RAW", "VOLTS": "ACQ:DATA:UNITS VOLTS"}
+_FORMAT_CMD = {"ASCII": "ACQ:DATA:FORMAT ASCII", "BIN": "ACQ:DATA:FORMAT BIN"}
+_VALID_DEC = frozenset(1 << k for k in range(17))     # Decimations supported by the Red Pitaya (1-65536)
 
 class ACQ():
     """## Red Pitaya Data Acquisition Class
     This class contains all the functions relevant to the Red Pitaya's data logger.
     """
-    def __init__(self, rp_s):
+    def __init__(self, rp_s, reset: bool = True):
         """Initialise Data Acquisition Setup
         
         ### Parameters
             rp_s : scpi.scpi
                 Red Pitaya scpi object.
+            reset : bool
+                Whether to reset and configure the acquisition. 
+                Use False for an additional connection that only reads data.
         """
         self.rp_s = rp_s                    # Sets the Red Pitaya device to be that given by the user
+        self._data_units = "VOLTS"
+        self._data_format = "ASCII"
+        self.__clear_settings_cache()
+        if not reset:
+            return
         self.redpitaya_reset()                      # Resets the acquire settings
         self.set_averaging("OFF")
         self.set_decimation(2048)
@@ -41,8 +47,19 @@ class ACQ():
     def redpitaya_reset(self):
         """Resets the data acquisition settings of the Red Pitaya."""
         self.rp_s.tx_txt("ACQ:RST")
+        self._data_units = "VOLTS"                  # The defaults restored by ACQ:RST
+        self._data_format = "ASCII"
+        self.__clear_settings_cache()
         return
 
+    def __clear_settings_cache(self):
+        """Forgets the last values sent by the setters, so they are all resent."""
+        self._last_dec = None
+        self._last_avg = None
+        self._last_units = None
+        self._last_format = None
+        self._last_trigger_level = None
+
     def start_logging(self):
         """Starts the data logging."""
         self.rp_s.tx_txt("ACQ:START")
@@ -60,17 +77,16 @@ class ACQ():
             dec : int
                 The decimation number, must be a power of 2
         """
+        if dec == self._last_dec:
+            return
 
-        is_power_of_two = (dec != 0) and ((dec & (dec - 1)) == 0)
+        if dec not in _VALID_DEC:
+            err = ValueError("Invalid decimation number")
+            err.add_note("The decimation value must be a power of 2 (up to 65536)")
+            raise err
 
-        try:
-            if is_power_of_two:
-                self.rp_s.tx_txt("ACQ:DEC " + str(dec))
-            else:
-                raise ValueError("Invalid decimation number")
-        except ValueError as e:
-            e.add_note("The decimation value must be a power of 2")
-            raise
+        self.rp_s.tx_txt(f"ACQ:DEC {dec}")
+        self._last_dec = dec
         return
 
     @exception_handler(logger)
@@ -81,13 +97,18 @@ class ACQ():
             state : str
                 The averaging state ("ON" or "OFF")    
         """
-        try:
-            if (state.upper() == "ON" or state.upper() == "OFF"):
-                self.rp_s.tx_txt("ACQ:AVG " + state.upper())
-            else:
-                raise ValueError("Invalid state")
-        except ValueError as e:
-            e.add_note("The possible states are \"ON\" or \"OFF\"")
+        state = state.upper()
+        if state == self._last_avg:
+            return
+
+        cmd = _AVG_CMD.get(state)
+        if cmd is None:
+            err = ValueError("Invalid state")
+            err.add_note("The possible states are \"ON\" or \"OFF\"")
+            raise err
+
+        self.rp_s.tx_txt(cmd)
+        self._last_avg = state
         return
 
     def get_write_pointer(self) -> int:
@@ -109,7 +130,7 @@ class ACQ():
                 The trigger delay in samples. A delay of 0 sets the trigger 
                 in the centre of the buffer (thus, the delay is actually 8192 samples).
         """
-        self.rp_s.tx_txt("ACQ:TRIG:DLY " + str(delay))
+        self.rp_s.tx_txt(f"ACQ:TRIG:DLY {delay}")
         return
     
     def set_trigger_level(self, level: float):
@@ -119,7 +140,11 @@ class ACQ():
             level : float
                 The trigger level in volts.
         """
-        self.rp_s.tx_txt("ACQ:TRIG:LEV " + str(level))
+        if level == self._last_trigger_level:
+            return
+
+        self.rp_s.tx_txt(f"ACQ:TRIG:LEV {level}")
+        self._last_trigger_level = level
         return
 
     @exception_handler(logger)
@@ -130,14 +155,43 @@ class ACQ():
             units : str
                 Data units ("RAW" or "VOLTS").
         """
-        try:
-            if (unit.upper() == "RAW" or unit.upper() == "VOLTS"):
-                self.rp_s.tx_txt("ACQ:DATA:UNITS " + unit.upper())
-            else:
-                raise ValueError
-        except ValueError as e:
-            e.add_note("The supported data units are RAW data units or VOLTS")
-            raise
+        unit = unit.upper()
+        if unit == self._last_units:
+            return
+
+        cmd = _UNITS_CMD.get(unit)
+        if cmd is None:
+            err = ValueError("Invalid data units")
+            err.add_note("The supported data units are RAW data units or VOLTS")
+            raise err
+
+        self.rp_s.tx_txt(cmd)
+        self._data_units = unit
+        self._last_units = unit
+        return
+
+    @exception_handler(logger)
+    def set_data_format(self, fmt: str):
+        """Sets the transfer format for the collected data.
+        
+        Parameters:
+            fmt : str
+                Data format ("ASCII" or "BIN"). 
+                BIN sends the samples as raw int16 (RAW) or float32 (VOLTS).
+        """
+        fmt = fmt.upper()
+        if fmt == self._last_format:
+            return
+
+        cmd = _FORMAT_CMD.get(fmt)
+        if cmd is None:
+            err = ValueError("Invalid data format")
+            err.add_note("The supported data formats are ASCII or BIN")
+            raise err
+
+        self.rp_s.tx_txt(cmd)
+        self._data_format = fmt
+        self._last_format = fmt
         return
 
     def set_trigger_state(self, channel: str):
@@ -147,7 +201,7 @@ class ACQ():
             channel : str
                 The trigger state/channel.
         """
-        self.rp_s.tx_txt("ACQ:TRIG " + channel)
+        self.rp_s.tx_txt(f"ACQ:TRIG {channel}")
         return
     
     def get_trigger_state(self) -> str:
@@ -161,7 +215,59 @@ class ACQ():
         state = self.rp_s.rx_txt()
         return state
 
-    def get_data_N(self, source: str, start: int, N: int) -> str:
+    def rx_arbitrary_block(self) -> bytearray:
+        """Reads an IEEE 488.2 definite length block ("#<ndigits><nbytes><data>").
+        
+        Returns:
+            buf : bytearray
+                The data contained in the block.
+        """
+        header = self.rx_block(2)
+        if header[:1] != b"#":
+            raise IOError("Invalid binary block header")
+        nbytes = int(self.rx_block(int(header[1:2])))
+        buf = self.rx_block(nbytes)
+        self.rx_block(len(self.rp_s.delimiter))       # Discards the trailing delimiter
+        return buf
+
+    def rx_block(self, nbytes: int) -> bytearray:
+        """Receives exactly nbytes from the Red Pitaya, straight into a preallocated buffer.
+        
+        Parameters:
+            nbytes : int
+                The number of bytes to receive.
+        
+        Returns:
+            buf : bytearray
+                The received bytes.
+        """
+        sock = self.rp_s._socket
+        buf = bytearray(nbytes)
+        mv = memoryview(buf)
+        got = 0
+
+        if hasattr(socket, "MSG_WAITALL"):
+            got = sock.recv_into(mv, nbytes, socket.MSG_WAITALL)     # Usually fills the buffer in one call
+        while got < nbytes:
+            n = sock.recv_into(mv[got:], nbytes - got)
+            if n == 0:
+                raise IOError("Connection closed by the Red Pitaya")
+            got += n
+        return buf
+
+    def __read_data(self) -> np.ndarray:
+        """Reads a data response in the current data format and units.
+        
+        Returns:
+            data : np.ndarray
+                The recorded data.
+        """
+        if self._data_format == "BIN":
+            return np.frombuffer(self.rx_arbitrary_block(), dtype=_BIN_DTYPE[self._data_units])
+        data = self.rp_s.rx_txt().strip("{}\n\r")
+        return np.fromstring(data, dtype=_ASCII_DTYPE[self._data_units], sep=",")
+
+    def get_data_N(self, source: str, start: int, N: int) -> np.ndarray:
         """Returns N data values from the buffer.
         
         Parameters:
@@ -173,17 +279,38 @@ class ACQ():
                 The number of buffer positions to read 
                 (starting from start and going to start + N, exclusively).
         Returns:
-            data : str
+            data : np.ndarray
                 The recorded data.
         """
-        self.rp_s.tx_txt("ACQ:" 
-                         + str(source) 
-                         + ":DATA:STA:N? " 
-                         + str(start) + "," + str(N))
-        data = self.rp_s.rx_txt() 
+        self.rp_s.tx_txt(f"ACQ:{source}:DATA:STA:N? {start},{N}")
+        data = self.__read_data()
         return data
     
-    def get_data(self, source: str) -> str:
+    def get_data_N_pipelined(self, source: str, ranges: list[tuple[int, int]]) -> list[np.ndarray]:
+        """Returns the data for several (start, N) ranges of the buffer.
+
+        In BIN format all the queries are sent before any response is read, 
+        so the ranges cost a single round trip. ASCII responses are read one 
+        query at a time, since rx_txt could read past the end of the first response.
+        
+        Parameters:
+            source : str
+                The input source that the data should be obtained from.
+            ranges : list[tuple[int, int]]
+                The (start, N) pairs to read, as in get_data_N.
+        Returns:
+            data : list[np.ndarray]
+                The recorded data for each range, in order.
+        """
+        if self._data_format != "BIN":
+            return [self.get_data_N(source, start, N) for start, N in ranges]
+
+        for start, N in ranges:
+            self.rp_s.tx_txt(f"ACQ:{source}:DATA:STA:N? {start},{N}")
+        data = [self.__read_data() for _ in ranges]
+        return data
+
+    def get_data(self, source: str) -> np.ndarray:
         """Gets all the data stored in the buffer.
         
         Parameters:
@@ -191,9 +318,9 @@ class ACQ():
                 The input source that the data should be obtained from.
         
         Returns:
-            data : str
+            data : np.ndarray
                 The recorded data.
         """
-        self.rp_s.tx_txt("ACQ:" + str(source) + "DATA?")
-        data = self.rp_s.rx_txt()
-        return data
\ No newline at end of file
+        self.rp_s.tx_txt(f"ACQ:{source}:DATA?")
+        data = self.__read_data()
+        return data
@@ -38,13 +38,13 @@ class scpi (object):
 
     def rx_txt(self, chunksize = 4096):
         """Receive text string and return it after removing the delimiter."""
-        msg = ''
+        msg = bytearray()
+        delimiter = self.delimiter.encode('utf-8')
         while 1:
-            chunk = self._socket.recv(chunksize).decode('utf-8') # Receive chunk size of 2^n preferably
-            msg += chunk
-            if (len(msg) and msg[-2:] == self.delimiter):
+            msg += self._socket.recv(chunksize) # Receive chunk size of 2^n preferably
+            if msg.endswith(delimiter):
                 break
-        return msg[:-2]
+        return msg[:-2].decode('utf-8') # Decoded once, after the whole message has arrived
 
     def rx_arb(self):
         numOfBytes = 0
@@ -1,38 +1,77 @@
 import time
 import sys
-import logging
-import os
+import socket
+import threading
 
-from ..error_handling.error_handling import exception_handler, formatter
+import numpy as np
+
+from ..error_handling.error_handling import exception_handler, get_logger
 from ..redpitaya import redpitaya_scpi as scpi
 from ..redpitaya import redpitaya as rp
 from . import tsl
 from ..get_address import get_address_IL
 
-filename = os.path.basename(__file__)
-filename = os.path.splitext(filename)[0]
-if not os.path.exists("./logs"):
-    os.mkdir("./logs")
-
-logger = logging.getLogger(filename)
-handler = logging.FileHandler(f"./logs/{filename}.log")
-
-handler.setLevel(logging.DEBUG)
-logger.setLevel(logging.DEBUG)
-
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+logger = get_logger(__name__.rsplit(".", 1)[-1])
 
 __author__ = "Andrew Kruger"
 
 BUFFER_SIZE = 16384       # Red Pitaya buffer size
+SAMPLE_RATE = 125e6       # Red Pitaya sample rate (before decimation)
 
 rp_s = scpi.scpi(sys.argv[1])
+rp_s_reader = scpi.scpi(sys.argv[1])        # Separate connection for the data reader thread
+
+for _connection in (rp_s, rp_s_reader):
+    # Sends the short SCPI commands immediately (no Nagle delay) and gives room for data bursts
+    _connection._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    _connection._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+
 _RP = rp.ACQ(rp_s)
+_RP_reader = rp.ACQ(rp_s_reader, reset=False)
 
 _TSL = tsl.TSL(get_address_IL(), "\r\n", "\r\n")
 _STS = tsl.STS(_TSL)
 _TRIG = tsl.TRIGGER(_TSL)
+_ASTS = tsl.AsyncSTS(_STS)
+
+_sweep_parameters = None    # The last parameters passed to set_sweep_parameters
+
+
+class _SampleBuffer:
+    """## Preallocated Sample Buffer
+
+    Collects the data chunks read from the Red Pitaya into a single 
+    preallocated array (which is only grown if the estimate was too small).
+    """
+    def __init__(self, n_expected: int, dtype = np.float32):
+        """Allocates the buffer.
+        
+        ### Parameters
+            n_expected : int
+                The expected number of samples.
+            dtype : numpy dtype
+                The sample type.
+        """
+        self.samples = np.empty(n_expected, dtype=dtype)
+        self.write_idx = 0
+
+    def append(self, chunk: np.ndarray):
+        """Copies a chunk of data to the end of the buffer.
+        
+        ### Parameters
+            chunk : np.ndarray
+                The data to add.
+        """
+        end = self.write_idx + chunk.size
+        if end > self.samples.size:
+            self.samples = np.resize(self.samples, max(end, 2 * self.samples.size))
+        self.samples[self.write_idx:end] = chunk
+        self.write_idx = end
+
+    def data(self) -> np.ndarray:
+        """Returns the collected samples."""
+        return self.samples[:self.write_idx]
+
 
 def set_wavelength(wavelength: str | int | float):
     """Sets the current wavlength of the TSL.
@@ -45,29 +84,59 @@ def set_wavelength(wavelength: str | int | float):
     return
 
 
-def get_data(previous_pointer: int):
+async def wait_for_sweep_state(state: str, poll_interval: float = 0.1, timeout: float | None = None) -> bool:
+    """Waits (without blocking the event loop) until the sweep state matches state.
+    
+    ### Parameters
+        state : str
+            The sweep state to wait for (eg. "Stopped").
+        poll_interval : float
+            The time between queries (in seconds).
+        timeout : float | None
+            The longest time to wait (in seconds), or None to wait indefinitely.
+
+    ### Returns
+        reached : bool
+            True if the state was reached before the timeout.
+    """
+    return await _ASTS.wait_for_state(state, poll_interval, timeout)
+
+
+def get_data(previous_pointer: int, current_pointer: int | None = None, acq: rp.ACQ | None = None):
     """Get all data from previous_pointer in the buffer to the current write pointer position.
     
     ### Parameters
         previous_pointer : int
             The previous recorded write pointer position.
 
+        current_pointer : int | None
+            The current write pointer position, if already known. 
+            The Red Pitaya is queried for it otherwise.
+
+        acq : rp.ACQ | None
+            The Red Pitaya connection to read from (_RP by default).
+
     ### Returns
-        buffer_string[1:] : str
-            A string containing the data (excluding a comma added at the start).
+        data : np.ndarray
+            The data between the two pointers.
         
         current_pointer : str
             The current write pointer.
     """
-    buffer_string = ""
-    current_pointer = _RP.get_write_pointer()
+    if acq is None:
+        acq = _RP
+    if current_pointer is None:
+        current_pointer = acq.get_write_pointer()
 
     if current_pointer < previous_pointer:
-        buffer_string = buffer_string + "," + _RP.get_data_N("SOUR1", previous_pointer, BUFFER_SIZE - previous_pointer) + "," + _RP.get_data_N("SOUR1", 1, current_pointer - 1)
+        ranges = [(previous_pointer, BUFFER_SIZE - previous_pointer)]      # Up to the end of the buffer
+        if current_pointer > 0:
+            ranges.append((0, current_pointer))                             # From the start of the buffer
+        data = np.concatenate(acq.get_data_N_pipelined("SOUR1", ranges))
     else:
-        buffer_string = buffer_string + "," + _RP.get_data_N("SOUR1", previous_pointer, current_pointer - previous_pointer)
+        data = acq.get_data_N("SOUR1", previous_pointer, current_pointer - previous_pointer)
 
-    return buffer_string[1:], current_pointer
+    return data, current_pointer
 
 
 def set_sweep_parameters(parameters : tsl.sweep_parameters_class):
@@ -77,28 +146,90 @@ def set_sweep_parameters(parameters : tsl.sweep_parameters_class):
         parameters : class TSL770.sweep_parameters_class
             A class containing the sweep parameters. These parameters are 
             the members start_wavelength, stop_wavelength, speed, and power.
+
+    ### Returns
+        sent : bool
+            True if the parameters were sent to the TSL.
     """
-    _STS.set_start_wavelength(parameters.start_wavelength)
-    _STS.set_stop_wavelength(parameters.stop_wavelength)
-    _STS.set_sweep_speed(parameters.speed)
-    _TSL.set_power(parameters.power)
-    return
+    global _sweep_parameters
+
+    if not _STS.set_sweep_parameters(parameters):
+        return False
+    _sweep_parameters = parameters
+    return True
+
 
+def _drain_buffer(previous_pointer: int, stop_event: threading.Event, samples: _SampleBuffer, 
+                  errors: list[Exception], max_delay: float = 0.02):
+    """Continually reads new data from the Red Pitaya buffer until stop_event is set.
+    
+    This runs in a separate thread with its own connection (_RP_reader). 
+    A final read is made after stop_event is set so no data is lost. 
+    The polling interval backs off exponentially (from 1 ms up to max_delay) 
+    while the write pointer is not moving. An exception ends the thread 
+    and is added to errors, so that sweep_STS can raise it.
+
+    ### Parameters
+        previous_pointer : int
+            The write pointer position to start reading from.
+
+        stop_event : threading.Event
+            Set once the acquisition has stopped.
+
+        samples : _SampleBuffer
+            The buffer that the data chunks are copied into.
+
+        errors : list[Exception]
+            Collects the exception that stopped the thread, if any.
+
+        max_delay : float
+            The longest time (in seconds) to wait between polls.
+    """
+    idle_iters = 0
 
-def sweep_STS() -> tuple[list[float], float]:
+    try:
+        while 1:
+            stopping = stop_event.is_set()
+            current_pointer = _RP_reader.get_write_pointer()
+
+            if current_pointer != previous_pointer:
+                chunk, previous_pointer = get_data(previous_pointer, current_pointer, _RP_reader)
+                samples.append(chunk)
+                idle_iters = 0
+            else:
+                idle_iters += 1
+
+            if stopping:
+                return
+            
+            time.sleep(min(0.001 * (1 << min(idle_iters, 5)), max_delay))
+    except Exception as e:
+        errors.append(e)
+
+
+def sweep_STS() -> tuple[np.ndarray, float]:
     """Runs the sweep.
     
     ### Returns
-        data : list[float]
-            Collected data in volts.
+        data : np.ndarray
+            Collected data in volts (float32).
         
         acquisition_time : float
             Red Pitaya data acquisition time.
     """
     dec = 2048
-    buffer_string = ""
     previous_pointer = 1
 
+    # Upper bound on the number of samples: the sweep duration plus two buffers of margin
+    if _sweep_parameters is not None:
+        sweep_time = (float(_sweep_parameters.stop_wavelength) 
+                      - float(_sweep_parameters.start_wavelength)) / float(_sweep_parameters.speed)
+    else:
+        sweep_time = 0
+    samples = _SampleBuffer(int(sweep_time * SAMPLE_RATE / dec) + 2 * BUFFER_SIZE)
+    stop_event = threading.Event()
+    drain_errors = []                       # The exception that stopped the drainer, if any
+
     _TRIG.set_external_trigger(0)
     _TRIG.set_trigger_output("Stop")
     _TRIG.set_trigger_standby(1)
@@ -108,10 +239,15 @@ def sweep_STS() -> tuple[list[float], float]:
     _RP.set_averaging("OFF")
     _RP.set_decimation(dec)
     _RP.set_data_units("Volts")
+    _RP.set_data_format("BIN")
+    _RP_reader.set_data_units("Volts")
+    _RP_reader.set_data_format("BIN")
     _RP.set_trigger_level(1)
 
     _STS.start_sweep()
-    time.sleep(3)
+    if not _STS.wait_ready():
+        _STS.stop_sweep()
+        raise TimeoutError("TSL not standing by for trigger")
     
     _RP.start_logging()
     time.sleep(131.072e-6 * dec)            # Gives the StemLab time to fill the buffer once
@@ -123,26 +259,35 @@ def sweep_STS() -> tuple[list[float], float]:
 
     _TRIG.send_software_trigger()             # Sends a software trigger to start the sweep
 
-    acquisition_time = 0
+    drainer = threading.Thread(
+        target=_drain_buffer, 
+        args=(previous_pointer, stop_event, samples, drain_errors, 
+              min(0.02, 131.072e-6 * dec / 4)),      # Polls at least 4 times per buffer fill
+        daemon=True
+    )
+    drainer.start()
 
-    while 1:
-        if _RP.get_trigger_state() == "TD":
-            _RP.stop_logging()
-            acquisition_end = time.time()
-            break
-            
-        buffer_string_temp, previous_pointer = get_data(previous_pointer)
-        buffer_string = buffer_string + "," + buffer_string_temp
-        
-    acquisition_time = acquisition_end - acquisition_start
+    try:
+        while 1:
+            if drain_errors:                # The data is incomplete, so the sweep has failed
+                break
+            if _RP.get_trigger_state() == "TD":
+                _RP.stop_logging()
+                acquisition_end = time.time()
+                break
+            time.sleep(1e-3)
+    finally:
+        stop_event.set()                    # Always stops the drainer, so it never outlives the sweep
+        drainer.join()
+
+    if drain_errors:
+        _RP.stop_logging()
+        _STS.stop_sweep()
+        raise drain_errors[0]
 
-    buffer_string_temp, previous_pointer = get_data(previous_pointer) 
-    buffer_string = buffer_string + "," + buffer_string_temp
+    acquisition_time = acquisition_end - acquisition_start
 
-    buffer_string = buffer_string[1:]
-    buffer_string = buffer_string.strip('{}\n\r').replace("  ", "").replace('{', "")
-    buffer_string = buffer_string.replace('}', "").split(',')
-    data = list(map(float, buffer_string[:-1]))    # Converts the data to a list of floats
+    data = samples.data()
     _STS.stop_sweep()
 
     return data, acquisition_time
\ No newline at end of file
@@ -1,43 +1,110 @@
-import pyvisa 
-import logging
+import time
+import asyncio
 from dataclasses import dataclass
-import os
+from functools import lru_cache
 
-from ..error_handling.error_handling import exception_handler, formatter
+from ..error_handling.error_handling import exception_handler, get_logger
+from ..get_address import get_gpib_resources
 
-filename = os.path.basename(__file__)
-filename = os.path.splitext(filename)[0]
-if not os.path.exists("./logs"):
-    os.mkdir("./logs")
-
-logger = logging.getLogger(filename)
-handler = logging.FileHandler(f"./logs/{filename}.log")
-
-handler.setLevel(logging.DEBUG)
-logger.setLevel(logging.DEBUG)
-
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+logger = get_logger(__name__.rsplit(".", 1)[-1])
 
 __author__ = "Andrew Kruger"
 
-### Resource manager ###
-rm = pyvisa.ResourceManager() 
-listing = rm.list_resources() # List of detected connections
-tools = [i for i in listing if 'GPIB' in i]
-
 tsl_version = 770
 
-@dataclass
+# SCPI command templates, chosen once for the TSL version (the TSL-550 takes values without units)
+if tsl_version == 770:
+    _SCPI = {
+        "wavelength": ":WAV {val}nm",
+        "power": ":POW {val}mW",
+        "sweep_step": ":WAV:SWE:STEP {val}pm",
+        "start_wavelength": ":WAV:SWE:STAR {val}nm",
+        "stop_wavelength": ":WAV:SWE:STOP {val}nm",
+        "sweep_speed": ":WAV:SWE:SPE {val}nm/s",
+    }
+    _STEP_SCALE = 1             # Step sent in pm
+else:
+    _SCPI = {
+        "wavelength": ":WAV {val}",
+        "power": ":POW {val}",
+        "sweep_step": ":WAV:SWE:STEP {val}",
+        "start_wavelength": ":WAV:SWE:STAR {val}",
+        "stop_wavelength": ":WAV:SWE:STOP {val}",
+        "sweep_speed": ":WAVE:SWE:SPE {val}",
+    }
+    _STEP_SCALE = 1e-3          # Step sent in nm
+
+# Command builders, cached since the same values are sent repeatedly
+@lru_cache(maxsize=256)
+def _wavelength_cmd(wavelength: str | int | float) -> str:
+    """Returns the command setting the wavelength (in nm), after checking it."""
+    if not 1480 <= wavelength <= 1640:
+        err = ValueError("Invalid wavelength")
+        err.add_note("The wavelength must be in the range 1480-1640 nm")
+        raise err
+    return _SCPI["wavelength"].format(val=wavelength)
+
+@lru_cache(maxsize=256)
+def _power_cmd(power: str | float | int) -> str:
+    """Returns the command setting the power (in mW), after checking it."""
+    if not power <= 13:
+        err = ValueError("Invalid power")
+        err.add_note("Power must be below 13 mW")
+        raise err
+    return _SCPI["power"].format(val=power)
+
+@lru_cache(maxsize=256)
+def _sweep_step_cmd(step: str | int | float) -> str:
+    """Returns the command setting the sweep step (in pm), after checking it."""
+    if not 0.1 <= step <= 160000:
+        err = ValueError("Invalid step size")
+        err.add_note("Only step sizes in the interval 0.1-160000 pm are supported")
+        raise err
+    return _SCPI["sweep_step"].format(val=step*_STEP_SCALE)
+
+@lru_cache(maxsize=256)
+def _start_wavelength_cmd(wavelength: str | int | float) -> str:
+    """Returns the command setting the sweep start wavelength (in nm), after checking it."""
+    if not 1480 <= wavelength <= 1640:
+        err = ValueError("Invalid wavelength")
+        err.add_note("Only wavelengths in the interval 1480-1640 nm are supported")
+        raise err
+    return _SCPI["start_wavelength"].format(val=wavelength)
+
+@lru_cache(maxsize=256)
+def _stop_wavelength_cmd(wavelength: str | int | float) -> str:
+    """Returns the command setting the sweep stop wavelength (in nm), after checking it."""
+    if not 1480 <= wavelength <= 1640:
+        err = ValueError("Invalid wavelength")
+        err.add_note("Only wavelengths in the interval 1480-1640 nm are supported")
+        raise err
+    return _SCPI["stop_wavelength"].format(val=wavelength)
+
+@lru_cache(maxsize=256)
+def _sweep_speed_cmd(speed: str | int | float) -> str:
+    """Returns the command setting the sweep speed (in nm/s), after checking it."""
+    if not 0.5 <= speed <= 200:
+        err = ValueError("Invalid sweep speed")
+        err.add_note("Only sweep speeds in the interval 0.5-200 nm/s are supported")
+        raise err
+    return _SCPI["sweep_speed"].format(val=speed)
+
+@dataclass(slots=True, frozen=True)
 class sweep_parameters_class:
     """## Sweep Parameters Data Class
 
-    Contains the members start_wavelength, stop_wavelength, speed, and power.
+    Contains the members start_wavelength, stop_wavelength, speed, and power. 
+    All members are converted to floats when the class is created. 
+    Instances are immutable and hashable, so they can be compared or used as cache keys.
     """
-    speed: int | str | float
-    power: int | str | float
-    start_wavelength: int | str | float = 1500
-    stop_wavelength: int | str | float = 1600
+    speed: float
+    power: float
+    start_wavelength: float = 1500
+    stop_wavelength: float = 1600
+
+    def __post_init__(self):
+        for name in ("speed", "power", "start_wavelength", "stop_wavelength"):
+            object.__setattr__(self, name, float(getattr(self, name)))
 
 
 class TSL:
@@ -56,15 +123,72 @@ class TSL:
             write_terminator : str
                 This is the write terminator.
         """
+        rm, tools = get_gpib_resources()      # Listed on first use and shared with get_address_IL
         self.buf = rm.open_resource(
             tools[int(laser) - 1], 
             read_termination = read_terminator, 
             write_termination = write_terminator
         )     
+        self.buf.chunk_size = 20480           # Lets a whole response arrive in a single read
+        self._term = write_terminator.encode("ascii")
+
+        self._cache: dict[str, str] = {}      # Query responses, cleared by the matching setters
 
-        self.GPIB = int(self.buf.query(":SYST:COMM:GPIB:ADDR?"))        # The GPIB address for the TSL
-        self.set_wavelength_unit("nm")
-        self.set_power_unit("mW")
+        self.GPIB = int(self._query_short(":SYST:COMM:GPIB:ADDR?"))        # The GPIB address for the TSL
+        self._write_block(":WAV:UNIT 0", ":POW:UNIT 1")                 # Units of nm and mW
+
+    def _write(self, cmd: str):
+        """Sends a command, appending the write terminator directly 
+        (skips pyvisa's write formatting).
+        
+        ### Parameters
+            cmd : str
+                The command to send.
+        """
+        self.buf.write_raw(cmd.encode("ascii") + self._term)
+
+    def _write_block(self, *cmds: str):
+        """Sends several commands in a single write.
+        
+        ### Parameters
+            cmds : str
+                The commands to send.
+        """
+        self._write(";".join(cmds))
+
+    def _query_short(self, cmd: str) -> str:
+        """Returns the response to a query with a short answer, read with a single raw read.
+        
+        ### Parameters
+            cmd : str
+                The query.
+        """
+        self._write(cmd)
+        return self.buf.read_raw(512).rstrip(b"\r\n").decode("ascii").strip()
+
+    def _cached_query(self, cmd: str) -> str:
+        """Returns the response to a query, only querying the TSL if it is not cached.
+        
+        ### Parameters
+            cmd : str
+                The query.
+        """
+        response = self._cache.get(cmd)
+        if response is None:
+            response = self._cache[cmd] = self._query_short(cmd)
+        return response
+
+    def invalidate(self, *cmds: str):
+        """Removes queries from the cache so they are read from the TSL again.
+        
+        ### Parameters
+            cmds : str
+                The queries to remove. The whole cache is cleared if none are given.
+        """
+        if not cmds:
+            self._cache.clear()
+        for cmd in cmds:
+            self._cache.pop(cmd, None)
 
     @exception_handler(logger)
     def set_wavelength_unit(self, unit: str):
@@ -77,10 +201,12 @@ class TSL:
         try:
             match unit.lower():
                 case "thz":
-                    self.buf.write(":WAV:UNIT 1")       # Sets the units to THz
+                    self._write(":WAV:UNIT 1")       # Sets the units to THz
+                    self.invalidate()
                     return
                 case "nm":
-                    self.buf.write(":WAV:UNIT 0")       # Sets the units to nm
+                    self._write(":WAV:UNIT 0")       # Sets the units to nm
+                    self.invalidate()
                     return
                 case _:
                     raise ValueError("Invalid unit")
@@ -95,7 +221,7 @@ class TSL:
             wavelength : str
                 This is the current wavelength of the TSL (in the chosen units, m by default).
         """
-        wavelength = self.buf.query(":WAV?")
+        wavelength = self._cached_query(":WAV?")
         return wavelength
     
     @exception_handler(logger)
@@ -106,16 +232,8 @@ class TSL:
             wavelength : int | str | float
                 This is the wavelength that the TSL will be set to (in nm)
         """
-        try:
-            if (1480 <= wavelength <= 1640) and (tsl_version == 770):
-                self.buf.write(":WAV " + str(wavelength) + "nm")
-            elif (1480 <= wavelength <= 1640) and (tsl_version == 550):
-                self.buf.write(":WAV " + str(wavelength))
-            else:
-                raise ValueError("Invalid wavelength")
-        except ValueError as e:
-            e.add_note("The wavelength must be in the range 1480-1640 nm")
-            raise
+        self._write(_wavelength_cmd(wavelength))
+        self.invalidate(":WAV?")
         return
 
     @exception_handler(logger)
@@ -128,7 +246,7 @@ class TSL:
         """
         try: 
             if (state == 0 or state == 1):
-                self.buf.write(":POW:STAT " + str(state))
+                self._write(":POW:STAT " + str(state))
             else:
                 raise ValueError("Invalid state")
         except ValueError as e:
@@ -152,7 +270,7 @@ class TSL:
                     unit = "1"
                 case _:
                     raise ValueError("Invalid unit")
-            self.buf.write(":POW:UNIT " + unit)
+            self._write(":POW:UNIT " + unit)
         except ValueError as e:
             e.add_note("Only dBm and mW are supported")
             raise
@@ -166,16 +284,7 @@ class TSL:
             power : str | float | int
                 The chosen power (in mW)
         """
-        try: 
-            if (power <= 13) and (tsl_version == 770):
-                self.buf.write(":POW " + str(power) + "mW")
-            elif (power <= 13) and (tsl_version == 550):
-                self.buf.write(":POW " + str(power))
-            else:
-                raise ValueError("Invalid power")
-        except ValueError as e:
-            e.add_note("Power must be below 13 mW")
-            raise
+        self._write(_power_cmd(power))
         return
 
 
@@ -192,7 +301,7 @@ class TRIGGER:
             laser : str | int
                 The index (+1) for the chosen TSL
         """
-        self.TSL = laser.buf
+        self._laser = laser             # All writes and queries go through the TSL
         self.set_external_trigger(1)
         self.set_trigger_edge(0)
         self.set_trigger_output("Stop")
@@ -207,7 +316,7 @@ class TRIGGER:
         """
         try:
             if (mode == 0 or mode == 1):
-                self.TSL.write(":TRIG:INP:EXT " + str(mode))
+                self._laser._write(":TRIG:INP:EXT " + str(mode))
             else:
                 raise ValueError("Invalid mode")
         except ValueError as e:
@@ -222,7 +331,7 @@ class TRIGGER:
             mode : str
                 The trigger mode. 0 for internal (front panel) and 1 for external (rear BNC)
         """
-        mode = self.TSL.write(":TRIG:INP:EXT?")
+        mode = self._laser._query_short(":TRIG:INP:EXT?")
         return mode
 
     @exception_handler(logger)
@@ -235,7 +344,7 @@ class TRIGGER:
         """
         try:
             if (edge == 0 or edge == 1):
-                self.TSL.write(":TRIG:INP:ACT " + str(edge))
+                self._laser._write(":TRIG:INP:ACT " + str(edge))
             else:
                 raise ValueError("Invalid mode")
         except ValueError as e:
@@ -247,7 +356,7 @@ class TRIGGER:
         """Sends a software trigger to the TSL 
         (this is used to remotely trigger the TSL when in external mode).
         """
-        self.TSL.write(":TRIG:INP:SOFT")
+        self._laser._write(":TRIG:INP:SOFT")
         return
         
     @exception_handler(logger)
@@ -261,7 +370,7 @@ class TRIGGER:
         """
         try:
             if (mode == 0 or mode == 1):
-                self.TSL.write(":TRIG:INP:STAN " + str(mode))
+                self._laser._write(":TRIG:INP:STAN " + str(mode))
             else:
                 raise ValueError("Invalid mode")
         except ValueError as e:
@@ -277,7 +386,7 @@ class TRIGGER:
                 Returns the current trigger mode. 
                 Returns 'ERROR!: Invalid Error' if the mode is not recognised.
         """
-        mode = self.TSL.write("TRIG:INP:STAN?")
+        mode = self._laser._query_short(":TRIG:INP:STAN?")
         match mode:
             case "0":
                 return "Normal operation mode"
@@ -310,7 +419,7 @@ class TRIGGER:
                     when = "3"
                 case _:
                     raise ValueError("Invalid value")
-            self.TSL.write(":TRIG:OUTP " + when)
+            self._laser._write(":TRIG:OUTP " + when)
         except ValueError as e:
             e.add_note("The valid values are None (no trigger), \
                        Stop (trigger at the end of the sweep), \
@@ -329,7 +438,7 @@ class TRIGGER:
                     - 'Start' for a trigger at the start of the sweep
                     - 'Step' for a trigger at each trigger step
         """
-        mode = self.TSL.write("TRIG:OUTP?")
+        mode = self._laser._query_short(":TRIG:OUTP?")
         match mode:
             case "0":
                 return "None"
@@ -353,12 +462,37 @@ class STS:
             laser : str | int
                 The index (+1) for the chosen TSL
         """
-        self.TSL = laser.buf
-        self.set_sweep_mode(1)
-        self.set_start_wavelength(1500)
-        self.set_stop_wavelength(1600)
-        self.set_sweep_step(0.1)
-        self.__set_sweep_cycles(0)
+        self._laser = laser             # All writes and queries go through the TSL (and its cache)
+        self._laser.invalidate(":WAV:SWE:MOD?", ":WAV:SWE:STAR?", ":WAV:SWE:STOP?", ":WAV:SWE:STEP?")
+        self._laser._write_block(
+            ":WAV:SWE:MOD 1",                   # One-way continuous sweep
+            _start_wavelength_cmd(1500),
+            _stop_wavelength_cmd(1600),
+            _sweep_step_cmd(0.1),
+            ":WAV:SWE:CYCL 0"
+        )
+
+    @exception_handler(logger)
+    def set_sweep_parameters(self, parameters: sweep_parameters_class):
+        """Sets the start and stop wavelengths, sweep speed and power in a single write.
+        
+        ### Parameters
+            parameters : sweep_parameters_class
+                The sweep parameters.
+
+        ### Returns
+            sent : bool
+                True once the parameters are sent 
+                (exception_handler returns None if sending them failed).
+        """
+        self._laser._write_block(
+            _start_wavelength_cmd(parameters.start_wavelength),
+            _stop_wavelength_cmd(parameters.stop_wavelength),
+            _sweep_speed_cmd(parameters.speed),
+            _power_cmd(parameters.power)
+        )
+        self._laser.invalidate(":WAV:SWE:STAR?", ":WAV:SWE:STOP?", ":WAV:SWE:SPE?")
+        return True
 
     def __set_sweep_cycles(self, cycles: str | int):
         """Sets the number of sweeps 
@@ -368,7 +502,7 @@ class STS:
             cycles : str | int
                 The number of sweeps to be run.
         """
-        self.TSL.write(":WAV:SWE:CYCL " + str(cycles))
+        self._laser._write(":WAV:SWE:CYCL " + str(cycles))
         return
 
     @exception_handler(logger)
@@ -379,16 +513,8 @@ class STS:
             step : str | int | float
                 The step size in pm.
         """
-        try:
-            if (0.1 <= step <= 160000) and (tsl_version == 770):
-                self.TSL.write(":WAV:SWE:STEP " + str(step) + "pm")
-            elif (0.1 <= step <= 160000) and (tsl_version == 550):
-                self.TSL.write(":WAV:SWE:STEP " + str(step*1e-3))
-            else:
-                raise ValueError("Invalid step size")
-        except ValueError as e:
-            e.add_note("Only step sizes in the interval 0.1-160000 pm are supported")
-            raise
+        self._laser._write(_sweep_step_cmd(step))
+        self._laser.invalidate(":WAV:SWE:STEP?")
         return
 
     @exception_handler(logger)
@@ -399,16 +525,8 @@ class STS:
             wavelength : str | int | float
                 The intial wavelength in nm
         """
-        try:
-            if (1480 <= wavelength <= 1640) and (tsl_version == 770):
-                self.TSL.write(":WAV:SWE:STAR " + str(wavelength) + "nm")
-            elif (1480 <= wavelength <= 1640) and (tsl_version == 550):
-                self.TSL.write(":WAV:SWE:STAR " + str(wavelength))
-            else:
-                raise ValueError("Invalid wavelength")
-        except ValueError as e:
-            e.add_note("Only wavelengths in the interval 1480-1640 nm are supported")
-            raise
+        self._laser._write(_start_wavelength_cmd(wavelength))
+        self._laser.invalidate(":WAV:SWE:STAR?")
         return
 
     def get_start_wavelength(self):
@@ -418,7 +536,7 @@ class STS:
             wavelength : str
                 The initial wavelength.
         """
-        wavelength = self.TSL.query(":WAV:SWE:STAR?") + "m"
+        wavelength = self._laser._cached_query(":WAV:SWE:STAR?") + "m"
         return wavelength
     
     @exception_handler(logger)
@@ -429,16 +547,8 @@ class STS:
             wavelength : str | int | float
                 The final wavelength in nm
         """
-        try:
-            if (1480 <= wavelength <= 1640) and (tsl_version == 770):
-                self.TSL.write(":WAV:SWE:STOP " + str(wavelength) + "nm")
-            elif (1480 <= wavelength <= 1640) and (tsl_version == 550):
-                self.TSL.write(":WAV:SWE:STOP " + str(wavelength))
-            else:
-                raise ValueError("Invalid wavelength")
-        except ValueError as e:
-            e.add_note("Only wavelengths in the interval 1480-1640 nm are supported")
-            raise
+        self._laser._write(_stop_wavelength_cmd(wavelength))
+        self._laser.invalidate(":WAV:SWE:STOP?")
         return
     
     def get_stop_wavelength(self):
@@ -448,7 +558,7 @@ class STS:
             wavelength : str
                 The final wavelength.
         """
-        wavelength = self.TSL.query(":WAV:SWE:STOP?") + "m"
+        wavelength = self._laser._cached_query(":WAV:SWE:STOP?") + "m"
         return wavelength
 
     @exception_handler(logger)
@@ -466,7 +576,8 @@ class STS:
         """
         try:
             if (mode == 0 or mode == 1 or mode == 2 or mode == 3):
-                self.TSL.write(":WAV:SWE:MOD " + str(mode))
+                self._laser._write(":WAV:SWE:MOD " + str(mode))
+                self._laser.invalidate(":WAV:SWE:MOD?")
             else:
                 raise ValueError("Invalid mode")
         except ValueError as e:
@@ -484,7 +595,7 @@ class STS:
             mode : str
                 The sweep mode.
         """
-        mode = self.TSL.query(":WAV:SWE:MOD?")
+        mode = self._laser._cached_query(":WAV:SWE:MOD?")
         match mode:
             case "0":
                 return "One-way step mode"
@@ -505,16 +616,8 @@ class STS:
             speed : str | int | float
                 The sweep speed in nm/s.
         """
-        try:
-            if (0.5 <= speed <= 200) and (tsl_version == 770):
-                self.TSL.write(":WAV:SWE:SPE " + str(speed) + "nm/s")
-            elif (0.5 <= speed <= 200) and (tsl_version == 550):
-                self.TSL.write(":WAVE:SWE:SPE " + str(speed))
-            else:
-                raise ValueError("Invalid sweep speed")
-        except ValueError as e:
-            e.add_note("Only sweep speeds in the interval 0.5-200 nm/s are supported")
-            raise
+        self._laser._write(_sweep_speed_cmd(speed))
+        self._laser.invalidate(":WAV:SWE:SPE?")
         return
     
     def get_sweep_speed(self):
@@ -524,7 +627,7 @@ class STS:
             speed : str
                 The sweep speed.
         """
-        speed = self.TSL.query(":WAV:SWE:SPE?") + "m/s"
+        speed = self._laser._cached_query(":WAV:SWE:SPE?") + "m/s"
         return speed
     
     def get_sweep_step(self):
@@ -534,12 +637,13 @@ class STS:
             step : str
                 The step size.
         """
-        step = self.TSL.query(":WAV:SWE:STEP?") + "m"
+        step = self._laser._cached_query(":WAV:SWE:STEP?") + "m"
         return step
 
     def start_sweep(self):
         """Starts the wavelength sweep."""
-        self.TSL.write(":WAV:SWE 1")
+        self._laser._write(":WAV:SWE 1")
+        self._laser.invalidate(":WAV?")             # The wavelength changes during the sweep
         return
 
     def get_sweep_state(self):
@@ -549,7 +653,7 @@ class STS:
             state : str
                 The current state of the sweep
         """
-        state = self.TSL.write(":WAV:SWE?") 
+        state = self._laser._query_short(":WAV:SWE?")
         match state:
             case "0":
                 return "Stopped"
@@ -562,7 +666,75 @@ class STS:
             case _:
                 return "(" + str(state) + ") " + "ERROR!: Invalid State"
 
+    def wait_ready(self, timeout: float = 5.0, poll_interval: float = 0.01) -> bool:
+        """Waits until the sweep is ready to start (standing by for the trigger).
+        
+        ### Parameters
+            timeout : float
+                The longest time to wait (in seconds).
+            poll_interval : float
+                The time between sweep state queries (in seconds).
+
+        ### Returns
+            ready : bool
+                True if the sweep became ready before the timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._laser._query_short(":WAV:SWE?") == "2":     # Standing by trigger
+                return True
+            time.sleep(poll_interval)
+
+        logger.warning(f"Sweep was not ready after {timeout} s")
+        return False
+
     def stop_sweep(self):
         """Stops the wavlength sweep."""
-        self.TSL.write(":WAV:SWE 0")
-        return
\ No newline at end of file
+        self._laser._write(":WAV:SWE 0")
+        self._laser.invalidate(":WAV?")
+        return
+
+
+class AsyncSTS:
+    """## Asynchronous STS Class
+    Wraps an STS so the sweep state can be polled from an asyncio event loop. 
+    The GPIB queries run in a worker thread, so the event loop is never blocked.
+    """
+    def __init__(self, sts: STS):
+        """Initialises the wrapper.
+        
+        ### Parameters
+            sts : STS
+                The swept test system to wrap.
+        """
+        self.sts = sts
+
+    async def aget_sweep_state(self) -> str:
+        """Gets the sweep state (see STS.get_sweep_state)."""
+        return await asyncio.to_thread(self.sts.get_sweep_state)
+
+    async def wait_for_state(self, state: str, poll_interval: float = 0.1, 
+                             timeout: float | None = None) -> bool:
+        """Polls the sweep state until it matches state.
+        
+        ### Parameters
+            state : str
+                The sweep state to wait for (eg. "Stopped").
+            poll_interval : float
+                The time between queries (in seconds).
+            timeout : float | None
+                The longest time to wait (in seconds), or None to wait indefinitely.
+
+        ### Returns
+            reached : bool
+                True if the state was reached before the timeout.
+        """
+        async def poll():
+            while await self.aget_sweep_state() != state:
+                await asyncio.sleep(poll_interval)
+
+        try:
+            await asyncio.wait_for(poll(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
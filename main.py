@@ -2,9 +2,10 @@ import PySimpleGUI as sg
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import pandas as pd
 import threading
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from RP_TSL770.sts import sts
 from RP_TSL770.error_handling.error_handling import exception_handler, formatter
@@ -25,49 +26,71 @@ logger.addHandler(event_handler)
 
 
 inputs = ["st", "en", "sp", "pw"]
+MAX_PLOT_POINTS = 4000                  # About twice the width of the canvas in pixels
 wave = []
 data = []
 toggle = {True: "Looping On", False: "Looping Off"}
 loop_state = False
 sweep_state = False
 wavelength_spin_value = 1500
+last_params = None                      # The sweep parameters last sent to the TSL
+# The only thread that talks to the instruments (pyvisa sessions are not thread-safe)
+instrument_executor = ThreadPoolExecutor(max_workers = 1)
 
-def sweep_plot(window, values, figure_canvas_agg, fig):
-    global sweep_state
-    sweep_state = True
+def log_error(future):
+    """Logs the exception raised by a finished instrument call or sweep, if any."""
+    if future.exception() is not None:
+        logger.error(future.exception(), exc_info = future.exception())
 
-    window["sweepButton"].update("Sweeping...")
+def run_on_instrument(function, *args):
+    """Queues a call on the instrument thread.
+    
+    ### Parameters
+        function : callable
+            The function to run.
+        
+        args
+            The arguments to pass to the function.
+    """
+    instrument_executor.submit(function, *args).add_done_callback(log_error)
 
-    params = sts.TSL770.sweep_parameters_class(
-        values["stSlider"],
-        values["enSlider"],
-        values["spSlider"],
-        values["pwSlider"]
-    )
+def sweep_plot(window, params, figure_canvas_agg, fig):
+    global last_params
 
-    sts.set_sweep_parameters(params)
-    data, acquisition_time = sts.sweep_STS()
+    window["sweepButton"].update("Sweeping...")
 
-    window["sweepButton"].update("Begin Sweep")
+    try:
+        if params != last_params:               # Only reconfigures the TSL if the parameters changed
+            if sts.set_sweep_parameters(params):
+                last_params = params            # Not remembered if sending failed, so the next sweep retries
+        data, acquisition_time = sts.sweep_STS()
+    finally:
+        window["sweepButton"].update("Begin Sweep")
 
     update_figure(figure_canvas_agg, data, acquisition_time, params, fig)
 
-    sweep_state = False
-
-def sweep_loop(window, values, figure_canvas_agg, fig):
+async def sweep_loop(window, values, figure_canvas_agg, fig):
     global sweep_state
 
-    while True:
-        sweep_state = True
-        sts.time.sleep(1)
-        sweep_plot(window, values, figure_canvas_agg, fig)
-        if not loop_state:
-            break
-
-def plot_data(y_data, acquisition_time: float | int, params: list[float | int]):
+    try:
+        params = sts.tsl.sweep_parameters_class(
+            start_wavelength = values["stSlider"],
+            stop_wavelength = values["enSlider"],
+            speed = values["spSlider"],
+            power = values["pwSlider"]
+        )
+
+        while True:
+            await sts.wait_for_sweep_state("Stopped", timeout = 1)
+            await asyncio.to_thread(sweep_plot, window, params, figure_canvas_agg, fig)
+            if not loop_state:
+                break
+    finally:
+        sweep_state = False
+
+def plot_data(y_data, acquisition_time: float | int, params, line):
     global wave
     global data
-    print("Plot params:", params)
     """Plots the data.
     
     ### Parameters
@@ -77,45 +100,62 @@ def plot_data(y_data, acquisition_time: float | int, params: list[float | int]):
         acquisition_time : float | int
             The total data acquisition time.
 
-        params : list[float | int]
-            A list containing the sweep parameters, 
-            of the the form [minwave, maxwave, speed, power].
+        params : sts.tsl.sweep_parameters_class
+            The sweep parameters (start_wavelength, stop_wavelength, speed, power).
+
+        line : (class) Line2D
+            The line that the data is drawn with.
     """
     t = np.linspace(0, acquisition_time, len(y_data))
-    print(t)
-    print(acquisition_time)
-    print(len(data))
-    t = [val 
-        for val in t 
-        if val >= acquisition_time - (params[1] - params[0])/params[2]]
-    wave = params[1] + params[2]*(t - t[-1])
-    data = y_data[-len(wave):]
-    plt.grid(True)
-    plt.title("Wavelength Sweep")
-    plt.xlabel("Wavelength (nm)")
-    plt.ylabel("Voltage (V)")
-    plt.plot(wave, data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Plot params: %r, acquisition time: %r, t: %r, samples: %d", 
+                     params, acquisition_time, t, len(y_data))
+    sweep_time = (params.stop_wavelength - params.start_wavelength)/params.speed
+    t = t[t >= acquisition_time - sweep_time]      # Keeps the samples taken during the sweep
+    wave = params.stop_wavelength + params.speed*(t - t[-1])
+    data = y_data[-wave.size:]
+    step = 2*wave.size // MAX_PLOT_POINTS            # Only draws about MAX_PLOT_POINTS points
+    if step > 1:
+        n_bins = wave.size // step
+        end = n_bins*step
+        bins = data[:end].reshape(n_bins, step)
+        # Draws the min and max of each bin (plus the leftover samples) so narrow dips and peaks stay visible
+        x = np.concatenate((np.repeat(wave[:end:step], 2), wave[end:]))
+        y = np.concatenate((np.column_stack((bins.min(1), bins.max(1))).ravel(), data[end:]))
+    else:
+        x, y = wave, data
+    line.set_data(np.asarray(x, dtype = np.float32), np.asarray(y, dtype = np.float32))
     return 
 
-def bind(win, element_type, bind_from, bind_to):
-    """Binds element events.
+def link_inputs(win):
+    """Links each slider to its InputText with Tk callbacks, so neither direction goes 
+    through the event loop (and a slider drag produces no events to coalesce).
+    
+    The slider's variable is traced to update the InputText as it moves. The InputText 
+    keeps its own variable (so it can be edited freely) and is pushed to the slider 
+    on <Return> or <FocusOut>, or reset to the slider's value if it is not a number.
 
     ### Parameters
         win : (class) Window
             PySimpleGUI Window.
+    """
+    for inp in inputs:
+        slider = win[inp + "Slider"].TKIntVar
+        entry = win[inp + "Input"]
 
-        element_type : str
-            Element type (eg. slider or button).
+        def show(*_, slider = slider, entry = entry):
+            entry.TKStringVar.set(f"{slider.get():g}")
 
-        bind_from : str
-            Event to bind.
+        def apply(_, slider = slider, entry = entry):
+            try:
+                slider.set(float(entry.TKStringVar.get()))      # The slider clamps it to its range
+            except ValueError:
+                pass
+            show()
 
-        bind_to : str
-            What the event binds to.
-    """
-    inputs = ["st", "en", "sp", "pw", "wave"]
-    for inp in inputs:
-        win[inp + element_type].bind(bind_from, bind_to)
+        slider.trace_add("write", show)
+        entry.TKEntry.bind("<Return>", apply)
+        entry.TKEntry.bind("<FocusOut>", apply)
 
 def draw_figure(figure_canvas_agg):
     """ Draws the figure onto the canvas.
@@ -128,18 +168,19 @@ def draw_figure(figure_canvas_agg):
     figure_canvas_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
     return figure_canvas_agg
 
-def delete_figure(figure_canvas_agg, fig):
-    """ Clears the current canvas.
+def setup_figure(fig):
+    """ Creates the axes, labels and the (empty) data line of the figure.
     
     ### Parameters
-        figure_canvas_agg : (class) FigureCanvasTkAgg
-            The canvas to be cleared.
-
         fig : (class) Figure
             The matplotlib.pyplot figure drawn on the canvas.
     """
-    figure_canvas_agg.get_tk_widget().forget()
-    fig.clf()
+    ax = fig.add_subplot(111)
+    ax.plot([], [])
+    ax.grid(True)
+    ax.set_title("Wavelength Sweep")
+    ax.set_xlabel("Wavelength (nm)")
+    ax.set_ylabel("Voltage (V)")
 
 def update_figure(figure_canvas_agg, data, acquisition_time, params, fig):
     """ Updates the figure on the canvas.
@@ -154,16 +195,17 @@ def update_figure(figure_canvas_agg, data, acquisition_time, params, fig):
         acquisition_time : float | int
             The total data acquisition time.
 
-        params : list[float | int]
-            A list containing the sweep parameters, 
-            of the the form [minwave, maxwave, speed, power].
+        params : sts.tsl.sweep_parameters_class
+            The sweep parameters (start_wavelength, stop_wavelength, speed, power).
 
         fig : (class) Figure
             The matplotlib.pyplot Figure that the data is plotted on.
     """
-    delete_figure(figure_canvas_agg, fig)
-    plot_data(data, acquisition_time, params)
-    draw_figure(figure_canvas_agg)
+    ax = fig.axes[0]
+    plot_data(data, acquisition_time, params, ax.lines[0])
+    ax.relim()
+    ax.autoscale_view()
+    figure_canvas_agg.draw_idle()
 
 if __name__ == "__main__":
     sg.theme("DarkBlue14")
@@ -174,7 +216,6 @@ if __name__ == "__main__":
             sg.Slider(orientation = "horizontal", 
                     key = "stSlider", 
                     range = (1500, 1600), 
-                    enable_events = True, 
                     resolution = 0.01),
             sg.InputText("1500", key = "stInput", size = (7, 1))
         ], 
@@ -183,7 +224,6 @@ if __name__ == "__main__":
             sg.Slider(orientation = "horizontal", 
                     key = "enSlider", 
                     range = (1500, 1600), 
-                    enable_events = True, 
                     resolution = 0.01), 
             sg.InputText("1500", key = "enInput", size = (7, 1))
         ],
@@ -192,7 +232,6 @@ if __name__ == "__main__":
             sg.Slider(orientation = "horizontal", 
                     key = "spSlider", 
                     range = (1, 200), 
-                    enable_events = True, 
                     resolution = 0.01), 
             sg.InputText("1", key = "spInput", size = (7, 1))
         ],
@@ -201,7 +240,6 @@ if __name__ == "__main__":
             sg.Slider(orientation = "horizontal", 
                     key = "pwSlider", 
                     range = (0, 3.0), 
-                    enable_events = True, 
                     resolution = 0.01), 
             sg.InputText("0", key = "pwInput", size = (7, 1))
         ],
@@ -210,7 +248,7 @@ if __name__ == "__main__":
         [sg.HSeparator()],
         [
             sg.Text("Wavelength"),
-            sg.InputText("1550", key="waveSpin", size(10, 1)),
+            sg.InputText("1550", key="waveSpin", size=(10, 1)),
             sg.Button("Set", key="-SET-")
         ],
         [
@@ -222,7 +260,7 @@ if __name__ == "__main__":
             sg.Text("Step Size (nm)"),
             sg.InputText("1", key="waveInput", size=(10, 1))
         ],
-        [sg.Text("", size=(30, 1), key="-ERROR-", text_color="red"]
+        [sg.Text("", size=(30, 1), key="-ERROR-", text_color="red")]
     ]
             
     """Layout of the Plot (right side of the window)"""
@@ -252,10 +290,15 @@ if __name__ == "__main__":
         resizable=True, 
         element_justification='c'
     )
-    bind(window, "Input", "<Return>", "_Enter")
+    link_inputs(window)
+
+    # Instrument I/O runs on an event loop in a background thread so the GUI stays responsive
+    async_loop = asyncio.new_event_loop()
+    async_loop.set_default_executor(instrument_executor)       # to_thread calls run on the instrument thread
+    threading.Thread(target = async_loop.run_forever, daemon = True).start()
 
     fig = plt.figure()
-    fig.clf()
+    setup_figure(fig)
     figure_canvas_agg = FigureCanvasTkAgg(fig, window['figCanvas'].TKCanvas)
     draw_figure(figure_canvas_agg)
 
@@ -275,39 +318,12 @@ if __name__ == "__main__":
             continue
     
         match event:
-            case "stInput_Enter":
-                window["stSlider"].update(str(values["stInput"]))
-                continue
-            case "enInput_Enter":
-                window["enSlider"].update(str(values["enInput"]))
-                continue
-            case "spInput_Enter":
-                window["spSlider"].update(str(values["spInput"]))
-                continue
-            case "pwInput_Enter":
-                window["pwSlider"].update(str(values["pwInput"]))
-                continue
-            case "stSlider":
-                window["stInput"].update(str(values["stSlider"]))
-                continue
-            case "enSlider":
-                window["enInput"].update(str(values["enSlider"]))
-                continue
-            case "pwSlider":
-                window["pwInput"].update(str(values["pwSlider"]))
-                continue
-            case "spSlider":
-                window["spInput"].update(str(values["spSlider"]))
-                continue
             case "sweepButton":
-                if not sweep_state:
-                    sweep_thread = threading.Thread(
-                        target = sweep_loop, 
-                        args = (window, values, 
-                            figure_canvas_agg, 
-                            fig), 
-                        daemon = True)
-                    sweep_thread.start()
+                if not sweep_state:             # Ignores clicks while a sweep is queued or running
+                    sweep_state = True
+                    asyncio.run_coroutine_threadsafe(
+                        sweep_loop(window, values, figure_canvas_agg, fig), 
+                        async_loop).add_done_callback(log_error)
                 continue
             
             case "loopButton":
@@ -317,29 +333,27 @@ if __name__ == "__main__":
 
             case "-SET-":
                 window["waveSpin"].update(round(wave_spin_val, 3))
-                sts.set_wavelength(wave_spin_val)
+                run_on_instrument(sts.set_wavelength, wave_spin_val)
                 continue
 
             case "↑":
                 wave_spin_val += wave_step
                 window["waveSpin"].update(round(wave_spin_val, 3))
-                sts.set_wavelength(wave_spin_val)
+                run_on_instrument(sts.set_wavelength, wave_spin_val)
                 continue
 
             case "↓":
                 wave_spin_val -= wave_step
                 window["waveSpin"].update(round(wave_spin_val, 3))
-                sts.set_wavelength(wave_spin_val)
+                run_on_instrument(sts.set_wavelength, wave_spin_val)
                 continue
 
             case "saveButton":
-                pd_data = pd.DataFrame(np.transpose(np.array([wave, data])))
                 filename = sg.popup_get_text("Enter file name", title = "CSV File Name")
-                print(filename[-4:])
-                if filename[-4:] == ".csv":
-                    pd_data.to_csv(filename, header = None, index = None)
-                else:
-                    pd_data.to_csv(filename + ".csv", header = None, index = None)
+                if filename is None:            # Cancelled
+                    continue
+                out_name = filename if filename.endswith(".csv") else filename + ".csv"
+                np.savetxt(out_name, np.column_stack((wave, data)), delimiter = ",", fmt = "%.10g")
                 continue
 
         window["-ERROR-"].update("")